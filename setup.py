@@ -5,9 +5,13 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
+import collections
+import concurrent.futures
 import datetime
 import distutils.command.clean
+import functools
 import glob
+import hashlib
 import json
 import os
 import platform
@@ -17,7 +21,7 @@ import shutil
 import subprocess
 import sys
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import setuptools
 import torch
@@ -29,6 +33,7 @@ from torch.utils.cpp_extension import (
 )
 
 this_dir = os.path.dirname(__file__)
+BUILD_CACHE_FILE = Path(this_dir) / "build" / ".xformers_build_cache.json"
 
 
 def get_extra_nvcc_flags_for_build_type(cuda_version: int) -> List[str]:
@@ -47,6 +52,29 @@ def get_extra_nvcc_flags_for_build_type(cuda_version: int) -> List[str]:
         raise ValueError(f"Unknown build type: {build_type}")
 
 
+def setup_compiler_cache(cuda_dir) -> None:
+    # Route nvcc through ccache/sccache when available: the CUTLASS and
+    # Flash-Attention kernels dominate the build, and most of them are
+    # unchanged between two builds
+    if "PYTORCH_NVCC" in os.environ:
+        return
+    for launcher in ["ccache", "sccache"]:
+        launcher_bin = shutil.which(launcher)
+        if launcher_bin is not None:
+            break
+    else:
+        return
+    nvcc_bin = "nvcc" if cuda_dir is None else os.path.join(cuda_dir, "bin", "nvcc")
+    print(f"Using {launcher} to cache nvcc compilation")
+    # ninja runs this through the shell: quote paths that contain spaces
+    if sys.platform == "win32":
+        os.environ["PYTORCH_NVCC"] = subprocess.list2cmdline([launcher_bin, nvcc_bin])
+    else:
+        os.environ["PYTORCH_NVCC"] = " ".join(
+            shlex.quote(p) for p in [launcher_bin, nvcc_bin]
+        )
+
+
 def fetch_requirements():
     with open("requirements.txt") as f:
         reqs = f.read().strip().split("\n")
@@ -64,6 +92,24 @@ def get_local_version_suffix() -> str:
     return f"+{git_hash}.d{date_suffix}"
 
 
+def load_build_cache() -> Dict[str, str]:
+    try:
+        return json.loads(BUILD_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def store_build_cache(key: str, value: str) -> None:
+    cache = load_build_cache()
+    cache[key] = value
+    try:
+        BUILD_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        BUILD_CACHE_FILE.write_text(json.dumps(cache))
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
 def get_flash_version() -> str:
     flash_dir = Path(__file__).parent / "third_party" / "flash-attention"
     try:
@@ -87,6 +133,24 @@ def generate_version_py(version: str) -> str:
     return content
 
 
+def linktree(src: Path, dst: Path) -> None:
+    # Like `shutil.copytree`, but hardlinks files instead of copying them
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as it:
+        for entry in it:
+            if entry.name == "__pycache__" or entry.name.endswith(".pyc"):
+                continue
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                linktree(Path(entry.path), Path(target))
+                continue
+            try:
+                os.link(entry.path, target)
+            except OSError:
+                # Cross-device, or no hardlink support: fallback to copy
+                shutil.copy2(entry.path, target)
+
+
 def symlink_package(name: str, path: Path, is_building_wheel: bool) -> None:
     cwd = Path(__file__).resolve().parent
     path_from = cwd / path
@@ -109,15 +173,17 @@ def symlink_package(name: str, path: Path, is_building_wheel: bool) -> None:
     if use_symlink:
         os.symlink(src=path_from, dst=path_to)
     else:
-        shutil.copytree(src=path_from, dst=path_to)
+        linktree(src=path_from, dst=Path(path_to))
 
 
+@functools.lru_cache(maxsize=None)
 def get_cuda_version(cuda_dir) -> int:
-    nvcc_bin = "nvcc" if cuda_dir is None else cuda_dir + "/bin/nvcc"
-    raw_output = subprocess.check_output([nvcc_bin, "-V"], universal_newlines=True)
-    output = raw_output.split()
-    release_idx = output.index("release") + 1
-    release = output[release_idx].split(".")
+    # `version.json` ships with CUDA 11.4+, and is much faster than `nvcc -V`
+    version_json = None if cuda_dir is None else Path(cuda_dir) / "version.json"
+    if version_json is not None and version_json.is_file():
+        release = json.loads(version_json.read_text())["cuda"]["version"].split(".")
+    else:
+        release = get_nvcc_release(cuda_dir).split(".")
     bare_metal_major = int(release[0])
     bare_metal_minor = int(release[1][0])
 
@@ -125,6 +191,24 @@ def get_cuda_version(cuda_dir) -> int:
     return bare_metal_major * 100 + bare_metal_minor
 
 
+def get_nvcc_release(cuda_dir) -> str:
+    nvcc_bin = "nvcc" if cuda_dir is None else cuda_dir + "/bin/nvcc"
+    nvcc_path = shutil.which(nvcc_bin)
+    cache_key = None
+    if nvcc_path is not None:
+        cache_key = f"nvcc_release:{nvcc_path}:{os.path.getmtime(nvcc_path)}"
+        cache = load_build_cache()
+        if cache_key in cache:
+            return cache[cache_key]
+    raw_output = subprocess.check_output([nvcc_bin, "-V"], universal_newlines=True)
+    output = raw_output.split()
+    release_idx = output.index("release") + 1
+    release = output[release_idx].rstrip(",")
+    if cache_key is not None:
+        store_build_cache(cache_key, release)
+    return release
+
+
 def get_hip_version(rocm_dir) -> str:
     hipcc_bin = "hipcc" if rocm_dir is None else os.path.join(rocm_dir, "bin", "hipcc")
     try:
@@ -142,18 +226,149 @@ def get_hip_version(rocm_dir) -> str:
     return None
 
 
-def get_flash_attention_extensions(cuda_version: int, extra_compile_args):
+def should_build_for_native_arch(cuda_version: int) -> bool:
+    # Local development builds only need to run on the GPUs of this machine:
+    # compiling for exactly those is much faster than for every default arch
+    native_arch = os.getenv("XFORMERS_NATIVE_ARCH", "")
+    if cuda_version < 1106 or native_arch == "0":
+        return False
+    if native_arch == "1":
+        return True
+    return (
+        os.getenv("TORCH_CUDA_ARCH_LIST", "") == ""
+        and "bdist_wheel" not in sys.argv
+        and torch.cuda.is_available()
+    )
+
+
+def get_local_cuda_archs() -> List[int]:
+    archs = []
+    for i in range(torch.cuda.device_count()):
+        major, minor = torch.cuda.get_device_capability(i)
+        archs.append(10 * major + minor)
+    return archs
+
+
+def get_max_jobs() -> Optional[int]:
+    # Same parsing as PyTorch: invalid values are ignored, and ninja then
+    # uses its own default
+    max_jobs = os.getenv("MAX_JOBS", "")
+    return int(max_jobs) if max_jobs.isdigit() else None
+
+
+def get_nvcc_split_compile() -> int:
+    # Every nvcc job spawns that many cicc/ptxas processes, and the CUTLASS
+    # kernels need a lot of memory: only use the cores ninja leaves idle
+    split_compile = os.getenv("XFORMERS_NVCC_SPLIT_COMPILE", "")
+    if split_compile.isdigit():
+        return int(split_compile)
+    num_cpus = os.cpu_count() or 1
+    max_jobs = get_max_jobs() or num_cpus
+    return max(1, num_cpus // max_jobs)
+
+
+def sort_sources_for_build(sources: List[str]) -> List[str]:
+    sources = sorted(sources)
+    # ninja starts jobs in the order they are listed: when building in
+    # parallel, start with the biggest files so that we don't end up waiting
+    # on a single huge CUTLASS kernel at the end of the build
+    if (get_max_jobs() or 1) > 1 or os.getenv("NINJA_STATUS"):
+        sources.sort(key=lambda p: -os.path.getsize(p))
+    return sources
+
+
+def get_flash_kernel_hdim(path: str) -> int:
+    match = re.search(r"_hdim(?P<hdim>[0-9]+)_", os.path.basename(path))
+    return 0 if match is None else int(match.group("hdim"))
+
+
+# Supports `9.0`, `9.0+PTX`, `9.0a+PTX` etc...
+PARSE_CUDA_ARCH_RE = re.compile(
+    r"(?P<major>[0-9]+)\.(?P<minor>[0-9])(?P<suffix>[a-zA-Z]{0,1})(?P<ptx>\+PTX){0,1}"
+)
+
+# Same as in `torch.utils.cpp_extension`. Order matters, as `Kepler` is a
+# prefix of `Kepler+Tesla`
+CUDA_NAMED_ARCHS = collections.OrderedDict(
+    [
+        ("Kepler+Tesla", "3.7"),
+        ("Kepler", "3.5+PTX"),
+        ("Maxwell+Tegra", "5.3"),
+        ("Maxwell", "5.0;5.2+PTX"),
+        ("Pascal", "6.0;6.1+PTX"),
+        ("Volta", "7.0+PTX"),
+        ("Turing", "7.5+PTX"),
+        ("Ampere+Tegra", "8.7"),
+        ("Ampere", "8.0;8.6+PTX"),
+        ("Ada", "8.9+PTX"),
+        ("Hopper", "9.0+PTX"),
+    ]
+)
+
+
+def parse_cuda_arch_list(
+    archs_list: str, cuda_version: int
+) -> List[Tuple[int, str, bool]]:
+    """
+    Parses a `TORCH_CUDA_ARCH_LIST`-like string into a list of
+    (sm number, suffix, embed PTX), skipping archs this nvcc can't target
+    """
+    # Expand named archs (eg `Ampere`) like `torch.utils.cpp_extension` does
+    for named_arch, arch_val in CUDA_NAMED_ARCHS.items():
+        archs_list = archs_list.replace(named_arch, arch_val)
+    cuda_archs = []
+    for arch in filter(None, archs_list.replace(" ", ";").split(";")):
+        match = PARSE_CUDA_ARCH_RE.match(arch)
+        assert match is not None, f"Invalid sm version: {arch}"
+        num = 10 * int(match.group("major")) + int(match.group("minor"))
+        # Sm90 requires nvcc 11.8+
+        if num >= 90 and cuda_version < 1108:
+            print(f"Skipping arch {arch}: requires nvcc 11.8+")
+            continue
+        cuda_archs.append((num, match.group("suffix"), match.group("ptx") is not None))
+    return cuda_archs
+
+
+def get_gencode_flags(
+    cuda_archs: List[Tuple[int, str, bool]], lto: bool = False
+) -> List[str]:
+    # With `lto`, emit LTO IR (`lto_XX`) to be optimized at device-link time
+    code = "lto" if lto else "sm"
+    nvcc_archs_flags = []
+    for num, suffix, ptx in cuda_archs:
+        nvcc_archs_flags.append(
+            f"-gencode=arch=compute_{num}{suffix},code={code}_{num}{suffix}"
+        )
+        if ptx:
+            nvcc_archs_flags.append(
+                f"-gencode=arch=compute_{num}{suffix},code=compute_{num}{suffix}"
+            )
+    # Embed PTX for the newest arch, so that the binary can still be JIT-ed
+    # on future GPUs. Arch-specific variants (eg `9.0a`) are not forward
+    # compatible, so use the generic one
+    if cuda_archs and not any(ptx for _, _, ptx in cuda_archs):
+        max_num = max(num for num, _, _ in cuda_archs)
+        nvcc_archs_flags.append(
+            f"-gencode=arch=compute_{max_num},code=compute_{max_num}"
+        )
+    return nvcc_archs_flags
+
+
+def get_flash_attention_extensions(
+    cuda_version: int,
+    extra_compile_args,
+    cuda_archs: Optional[List[Tuple[int, str, bool]]] = None,
+):
     # XXX: Not supported on windows for cuda<12
     # https://github.com/Dao-AILab/flash-attention/issues/345
     if platform.system() != "Linux" and cuda_version < 1200:
         return []
     # Figure out default archs to target
+    # NOTE: Sm80 binaries also run on Sm86/Sm89, so no need to build for those
     DEFAULT_ARCHS_LIST = ""
     if cuda_version >= 1108:
-        DEFAULT_ARCHS_LIST = "8.0;8.6;9.0"
-    elif cuda_version > 1100:
-        DEFAULT_ARCHS_LIST = "8.0;8.6"
-    elif cuda_version == 1100:
+        DEFAULT_ARCHS_LIST = "8.0;9.0"
+    elif cuda_version >= 1100:
         DEFAULT_ARCHS_LIST = "8.0"
     else:
         return []
@@ -161,32 +376,20 @@ def get_flash_attention_extensions(cuda_version: int, extra_compile_args):
     if os.getenv("XFORMERS_DISABLE_FLASH_ATTN", "0") != "0":
         return []
 
-    # Supports `9.0`, `9.0+PTX`, `9.0a+PTX` etc...
-    PARSE_CUDA_ARCH_RE = re.compile(
-        r"(?P<major>[0-9]+)\.(?P<minor>[0-9])(?P<suffix>[a-zA-Z]{0,1})(?P<ptx>\+PTX){0,1}"
+    if cuda_archs is None:
+        cuda_archs = parse_cuda_arch_list(DEFAULT_ARCHS_LIST, cuda_version)
+    # Need at least Sm80
+    nvcc_archs_flags = get_gencode_flags(
+        [(num, suffix, ptx) for num, suffix, ptx in cuda_archs if num >= 80]
     )
-    archs_list = os.environ.get("TORCH_CUDA_ARCH_LIST", DEFAULT_ARCHS_LIST)
-    nvcc_archs_flags = []
-    for arch in archs_list.replace(" ", ";").split(";"):
-        match = PARSE_CUDA_ARCH_RE.match(arch)
-        assert match is not None, f"Invalid sm version: {arch}"
-        num = 10 * int(match.group("major")) + int(match.group("minor"))
-        # Need at least Sm80
-        if num < 80:
-            continue
-        # Sm90 requires nvcc 11.8+
-        if num >= 90 and cuda_version < 1108:
-            continue
-        suffix = match.group("suffix")
-        nvcc_archs_flags.append(
-            f"-gencode=arch=compute_{num}{suffix},code=sm_{num}{suffix}"
-        )
-        if match.group("ptx") is not None:
-            nvcc_archs_flags.append(
-                f"-gencode=arch=compute_{num}{suffix},code=compute_{num}{suffix}"
-            )
     if not nvcc_archs_flags:
         return []
+    if should_build_for_native_arch(cuda_version):
+        local_archs = get_local_cuda_archs()
+        if local_archs and all(
+            num >= 80 and (num < 90 or cuda_version >= 1108) for num in local_archs
+        ):
+            nvcc_archs_flags = ["-arch=native"]
 
     flash_root = os.path.join(this_dir, "third_party", "flash-attention")
     cutlass_inc = os.path.join(flash_root, "csrc", "cutlass", "include")
@@ -196,8 +399,13 @@ def get_flash_attention_extensions(cuda_version: int, extra_compile_args):
             "to run `git submodule update --init --recursive` ?"
         )
 
+    # NOTE: `flash_api.cpp` defines the python module, so this has to remain a
+    # single extension. The kernels are already sharded in one file per
+    # (head dim, dtype, causal) config which ninja compiles in parallel: queue
+    # the largest head dims first as they take the longest to build
     sources = ["csrc/flash_attn/flash_api.cpp"]
-    for f in glob.glob(os.path.join(flash_root, "csrc", "flash_attn", "src", "*.cu")):
+    kernels = glob.glob(os.path.join(flash_root, "csrc", "flash_attn", "src", "*.cu"))
+    for f in sorted(kernels, key=lambda f: (-get_flash_kernel_hdim(f), f)):
         sources.append(str(Path(f).relative_to(flash_root)))
     common_extra_compile_args = ["-DFLASHATTENTION_DISABLE_ALIBI"]
     return [
@@ -236,26 +444,90 @@ def get_flash_attention_extensions(cuda_version: int, extra_compile_args):
 
 
 def rename_cpp_cu(cpp_files):
+    # Symlinks keep the mtime of the `.cpp`, so ninja doesn't rebuild
+    # everything on every build like it would with fresh copies
     for entry in cpp_files:
-        shutil.copy(entry, os.path.splitext(entry)[0] + ".cu")
+        target = os.path.splitext(entry)[0] + ".cu"
+        if os.path.exists(target) and os.path.samefile(entry, target):
+            continue
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.symlink(src=os.path.basename(entry), dst=target)
+        except OSError:
+            # Windows requires special permission to symlink
+            shutil.copy2(entry, target)
+
+
+def maybe_generate_cutlass_kernels() -> bool:
+    # `generate_kernels.py` stores its own hash next to the files it generates.
+    # If it doesn't match, the checked-in kernels are stale: regenerate them
+    fmha_dir = Path(this_dir) / "xformers" / "csrc" / "attention" / "cuda" / "fmha"
+    generator = fmha_dir / "generate_kernels.py"
+    stamp = fmha_dir / "autogen" / "generate_kernels.sha256"
+    if not generator.is_file():
+        return False
+    # Normalize line endings, for checkouts with `core.autocrlf`
+    digest = hashlib.sha256(generator.read_bytes().replace(b"\r\n", b"\n")).hexdigest()
+    if stamp.is_file() and stamp.read_text().strip() == digest:
+        return False
+    print(f"{generator} does not match the generated CUTLASS kernels, regenerating")
+    subprocess.check_call([sys.executable, str(generator)])
+    return True
+
+
+def is_cuda_build() -> bool:
+    return (
+        (torch.cuda.is_available() and ((CUDA_HOME is not None)))
+        or os.getenv("FORCE_CUDA", "0") == "1"
+        or os.getenv("TORCH_CUDA_ARCH_LIST", "") != ""
+    )
+
+
+def is_inplace_build() -> bool:
+    # `pip install -e .` runs either `develop` or `editable_wheel`
+    return (
+        "develop" in sys.argv
+        or "editable_wheel" in sys.argv
+        or ("build_ext" in sys.argv and ("--inplace" in sys.argv or "-i" in sys.argv))
+    )
+
+
+def collect_sources(root: str, suffixes: List[str]) -> Dict[str, List[str]]:
+    # Walks the tree once and buckets files by extension
+    collected: Dict[str, List[str]] = {suffix: [] for suffix in suffixes}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            suffix = os.path.splitext(filename)[1]
+            if suffix in collected:
+                collected[suffix].append(os.path.join(dirpath, filename))
+    return collected
+
+
+def uses_cutlass_examples(sources: List[str], examples_dir: str) -> bool:
+    # The CUTLASS examples tree is large, and every include path is searched
+    # for each `#include`: only add it if something includes from it
+    if not os.path.isdir(examples_dir):
+        return False
+    example_dirs = set(os.listdir(examples_dir))
+    include_re = re.compile(r'#include\s*["<](?P<dir>[^/">]+)/')
+    for source in sources:
+        with open(source, errors="ignore") as f:
+            for match in include_re.finditer(f.read()):
+                if match.group("dir") in example_dirs:
+                    return True
+    return False
 
 
 def get_extensions():
     extensions_dir = os.path.join("xformers", "csrc")
+    hip_dir = os.path.join(extensions_dir, "attention", "hip_fmha") + os.sep
 
-    sources = glob.glob(os.path.join(extensions_dir, "**", "*.cpp"), recursive=True)
-    source_cuda = glob.glob(os.path.join(extensions_dir, "**", "*.cu"), recursive=True)
-    source_hip = glob.glob(
-        os.path.join(extensions_dir, "attention", "hip_fmha", "**", "*.cpp"),
-        recursive=True,
-    )
-    source_hip_generated = glob.glob(
-        os.path.join(extensions_dir, "attention", "hip_fmha", "**", "*.cu"),
-        recursive=True,
-    )
+    all_sources = collect_sources(extensions_dir, [".cpp", ".cu", ".h", ".cuh"])
+    sources = [f for f in all_sources[".cpp"] if not f.startswith(hip_dir)]
+    source_hip = [f for f in all_sources[".cpp"] if f.startswith(hip_dir)]
     # avoid the temporary .cu files generated under xformers/csrc/attention/hip_fmha
-    source_cuda = list(set(source_cuda) - set(source_hip_generated))
-    sources = list(set(sources) - set(source_hip))
+    source_cuda = [f for f in all_sources[".cu"] if not f.startswith(hip_dir)]
 
     sputnik_dir = os.path.join(this_dir, "third_party", "sputnik")
     cutlass_dir = os.path.join(this_dir, "third_party", "cutlass", "include")
@@ -268,6 +540,7 @@ def get_extensions():
         )
 
     extension = CppExtension
+    extension_kwargs = {}
 
     define_macros = []
 
@@ -277,6 +550,25 @@ def get_extensions():
         extra_compile_args["cxx"].extend(["/MP", "/Zc:lambda", "/Zc:preprocessor"])
     elif "OpenMP not found" not in torch.__config__.parallel_info():
         extra_compile_args["cxx"].append("-fopenmp")
+    # Let the compiler vectorize the CPU kernels for the local machine. Only on
+    # by default for editable/in-place builds: anything else (wheels, conda,
+    # `setup.py install`...) may run on another CPU
+    default_enable_native = "1" if is_inplace_build() else "0"
+    is_x86 = platform.machine() in ("x86_64", "AMD64")
+    if os.getenv("XFORMERS_ENABLE_AVX2", "0") == "1" and is_x86:
+        # Explicit opt-in: the binary won't run on CPUs without AVX2
+        if sys.platform == "win32":
+            extra_compile_args["cxx"].append("/arch:AVX2")
+        else:
+            extra_compile_args["cxx"].extend(["-mavx2", "-mfma", "-mf16c"])
+    elif (
+        os.getenv("XFORMERS_ENABLE_NATIVE", default_enable_native) == "1"
+        and sys.platform != "win32"
+    ):
+        if is_x86:
+            extra_compile_args["cxx"].append("-march=native")
+        elif platform.machine() in ("arm64", "aarch64"):
+            extra_compile_args["cxx"].append("-mcpu=native")
 
     include_dirs = [extensions_dir]
     ext_modules = []
@@ -284,33 +576,46 @@ def get_extensions():
     hip_version = None
     flash_version = "0.0.0"
 
-    if (
-        (torch.cuda.is_available() and ((CUDA_HOME is not None)))
-        or os.getenv("FORCE_CUDA", "0") == "1"
-        or os.getenv("TORCH_CUDA_ARCH_LIST", "") != ""
-    ):
+    if is_cuda_build():
         cuda_version = get_cuda_version(CUDA_HOME)
+        setup_compiler_cache(CUDA_HOME)
         extension = CUDAExtension
+        if maybe_generate_cutlass_kernels():
+            source_cuda = [
+                f
+                for f in collect_sources(extensions_dir, [".cu"])[".cu"]
+                if not f.startswith(hip_dir)
+            ]
         sources += source_cuda
-        include_dirs += [sputnik_dir, cutlass_dir, cutlass_examples_dir]
+        include_dirs += [sputnik_dir, cutlass_dir]
+        cuda_headers = all_sources[".h"] + all_sources[".cuh"]
+        if uses_cutlass_examples(
+            [f for f in source_cuda + cuda_headers if not f.startswith(hip_dir)],
+            cutlass_examples_dir,
+        ):
+            include_dirs.append(cutlass_examples_dir)
         nvcc_flags = [
             "-DHAS_PYTORCH",
-            "--use_fast_math",
             "-U__CUDA_NO_HALF_OPERATORS__",
             "-U__CUDA_NO_HALF_CONVERSIONS__",
             "--extended-lambda",
             "-D_ENABLE_EXTENDED_ALIGNED_STORAGE",
             "-std=c++17",
         ] + get_extra_nvcc_flags_for_build_type(cuda_version)
+        # NOTE: Flash-Attention always builds with `--use_fast_math`
+        if os.getenv("XFORMERS_FAST_MATH", "1") == "1":
+            nvcc_flags.append("--use_fast_math")
         if os.getenv("XFORMERS_ENABLE_DEBUG_ASSERTIONS", "0") != "1":
             nvcc_flags.append("-DNDEBUG")
         nvcc_flags += shlex.split(os.getenv("NVCC_FLAGS", ""))
         if cuda_version >= 1102:
             nvcc_flags += [
                 "--threads",
-                "4",
+                str(min(os.cpu_count() or 1, 16)),
                 "--ptxas-options=-v",
             ]
+        if cuda_version >= 1108:
+            nvcc_flags += ["-Xfatbin=-compress-all"]
         if sys.platform == "win32":
             nvcc_flags += [
                 "-Xcompiler",
@@ -320,8 +625,18 @@ def get_extensions():
             ]
         extra_compile_args["nvcc"] = nvcc_flags
 
+        # Parsed once for both extensions. If unset, Flash-Attention uses its
+        # own default archs and PyTorch picks the archs for `xformers._C`
+        cuda_archs = None
+        if os.getenv("TORCH_CUDA_ARCH_LIST", "") != "":
+            cuda_archs = parse_cuda_arch_list(
+                os.environ["TORCH_CUDA_ARCH_LIST"], cuda_version
+            )
+
         flash_extensions = get_flash_attention_extensions(
-            cuda_version=cuda_version, extra_compile_args=extra_compile_args
+            cuda_version=cuda_version,
+            extra_compile_args=extra_compile_args,
+            cuda_archs=cuda_archs,
         )
 
         if flash_extensions:
@@ -336,6 +651,35 @@ def get_extensions():
             "--ptxas-options=-O2",
             "--ptxas-options=-allow-expensive-optimizations=true",
         ]
+        split_compile = get_nvcc_split_compile()
+        if cuda_version >= 1204 and split_compile > 1:
+            # Parallelizes the device compilation phases (cicc/ptxas) of a TU
+            extra_compile_args["nvcc"].append(f"--split-compile={split_compile}")
+        enable_dlto = (
+            cuda_version >= 1102 and os.getenv("XFORMERS_ENABLE_DLTO", "0") == "1"
+        )
+        if enable_dlto:
+            # Device link-time optimization needs explicit `lto_XX` targets
+            if cuda_archs is None:
+                cuda_archs = [(num, "", False) for num in get_local_cuda_archs()]
+            if not cuda_archs:
+                raise RuntimeError(
+                    "XFORMERS_ENABLE_DLTO=1 requires TORCH_CUDA_ARCH_LIST to be "
+                    "set, or a visible GPU"
+                )
+            # Requires relocatable device code. PyTorch adds `-dlto` to the
+            # device-link step, which produces the final SASS for those archs
+            extension_kwargs["dlink"] = True
+            extra_compile_args["nvcc"].append("-rdc=true")
+            extra_compile_args["nvcc"] += get_gencode_flags(cuda_archs, lto=True)
+            extra_compile_args["nvcc_dlink"] = [
+                flag for flag in get_gencode_flags(cuda_archs) if ",code=sm_" in flag
+            ]
+        elif should_build_for_native_arch(cuda_version):
+            extra_compile_args["nvcc"].append("-arch=native")
+        elif cuda_archs is not None:
+            # Explicit gencodes disable PyTorch's own parsing of the arch list
+            extra_compile_args["nvcc"] += get_gencode_flags(cuda_archs)
     elif torch.cuda.is_available() and torch.version.hip:
         rename_cpp_cu(source_hip)
         rocm_home = os.getenv("ROCM_PATH")
@@ -386,10 +730,11 @@ def get_extensions():
     ext_modules.append(
         extension(
             "xformers._C",
-            sorted(sources),
+            sort_sources_for_build(sources),
             include_dirs=[os.path.abspath(p) for p in include_dirs],
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            **extension_kwargs,
         )
     )
 
@@ -408,6 +753,12 @@ def get_extensions():
                 "PYTORCH_ROCM_ARCH",
                 "XFORMERS_BUILD_TYPE",
                 "XFORMERS_ENABLE_DEBUG_ASSERTIONS",
+                "XFORMERS_NATIVE_ARCH",
+                "XFORMERS_ENABLE_DLTO",
+                "XFORMERS_ENABLE_NATIVE",
+                "XFORMERS_ENABLE_AVX2",
+                "XFORMERS_FAST_MATH",
+                "XFORMERS_NVCC_SPLIT_COMPILE",
                 "NVCC_FLAGS",
                 "XFORMERS_PACKAGE_FROM",
             ]
@@ -415,17 +766,28 @@ def get_extensions():
     }
 
 
+def remove_path(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except OSError:
+        shutil.rmtree(filename, ignore_errors=True)
+
+
 class clean(distutils.command.clean.clean):  # type: ignore
     def run(self):
         if os.path.exists(".gitignore"):
             with open(".gitignore", "r") as f:
                 ignores = f.read()
-                for wildcard in filter(None, ignores.split("\n")):
-                    for filename in glob.glob(wildcard):
-                        try:
-                            os.remove(filename)
-                        except OSError:
-                            shutil.rmtree(filename, ignore_errors=True)
+            filenames = [
+                filename
+                for wildcard in filter(None, ignores.split("\n"))
+                for filename in glob.glob(wildcard)
+            ]
+            # Removal is bound by unlink syscalls, which release the GIL
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=(os.cpu_count() or 1) * 2
+            ) as executor:
+                list(executor.map(remove_path, filenames))
 
         # It's an old-style class in Python 2.7...
         distutils.command.clean.clean.run(self)
@@ -440,9 +802,11 @@ class BuildExtensionWithExtraFiles(BuildExtension):
     def build_extensions(self) -> None:
         super().build_extensions()
         for filename, content in self.xformers_build_metadata.items():
-            with open(
-                os.path.join(self.build_lib, self.pkg_name, filename), "w+"
-            ) as fp:
+            target = os.path.join(self.build_lib, self.pkg_name, filename)
+            # Keep the file (and its mtime) untouched if nothing changed
+            if os.path.isfile(target) and Path(target).read_text() == content:
+                continue
+            with open(target, "w+") as fp:
                 fp.write(content)
 
     def copy_extensions_to_source(self) -> None:
@@ -453,21 +817,26 @@ class BuildExtensionWithExtraFiles(BuildExtension):
         build_py = self.get_finalized_command("build_py")
         package_dir = build_py.get_package_dir(self.pkg_name)
 
-        for filename in self.xformers_build_metadata.keys():
+        for filename, content in self.xformers_build_metadata.items():
             inplace_file = os.path.join(package_dir, filename)
             regular_file = os.path.join(self.build_lib, self.pkg_name, filename)
+            if (
+                os.path.isfile(inplace_file)
+                and Path(inplace_file).read_text() == content
+            ):
+                continue
             self.copy_file(regular_file, inplace_file, level=self.verbose)
         super().copy_extensions_to_source()
 
 
 if __name__ == "__main__":
-    if os.getenv("BUILD_VERSION"):  # In CI
-        version = os.getenv("BUILD_VERSION", "0.0.0")
-    else:
-        version_txt = os.path.join(this_dir, "version.txt")
-        with open(version_txt) as f:
-            version = f.readline().strip()
-        version += get_local_version_suffix()
+    # Both only wait on `git` subprocesses: run them concurrently with the
+    # rest of the setup. `get_flash_version` caches its result for later, and
+    # is only needed when building the CUDA extensions
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    local_version_suffix = executor.submit(get_local_version_suffix)
+    if is_cuda_build():
+        executor.submit(get_flash_version)
 
     is_building_wheel = "bdist_wheel" in sys.argv
     # Embed a fixed version of flash_attn
@@ -480,6 +849,16 @@ if __name__ == "__main__":
         Path("third_party") / "flash-attention" / "flash_attn",
         is_building_wheel,
     )
+
+    if os.getenv("BUILD_VERSION"):  # In CI
+        version = os.getenv("BUILD_VERSION", "0.0.0")
+    else:
+        version_txt = os.path.join(this_dir, "version.txt")
+        with open(version_txt) as f:
+            version = f.readline().strip()
+        version += local_version_suffix.result()
+    executor.shutdown(wait=True)
+
     extensions, extensions_metadata = get_extensions()
     setuptools.setup(
         name="xformers",
@@ -9,6 +9,7 @@
 # we select the first kernel in the list that supports the inputs
 
 import collections
+import hashlib
 import itertools
 from dataclasses import dataclass, field
 from pathlib import Path
@@ -382,3 +383,9 @@ write_decl_impl(
     impl_file="kernel_backward.h",
     disable_def="XFORMERS_MEM_EFF_ATTENTION_DISABLE_BACKWARD",
 )
+
+# Lets `setup.py` detect when the generated files are out of date
+(Path(__file__).parent / "autogen" / "generate_kernels.sha256").write_text(
+    hashlib.sha256(Path(__file__).read_bytes().replace(b"\r\n", b"\n")).hexdigest()
+    + "\n"
+)